@@ -9,8 +9,13 @@ Date: 2023-01-25 (last updated)
 Version: 2.0
 """
 
+import io
 import math
-import random
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from numpy.random import Generator, SFC64
 
 # === DEBUG CONFIGURATION ===
 DEBUG = False
@@ -22,13 +27,13 @@ def Output(ti, pId, coord, file_handle):
     Output particle data in standard CFD format to file.
     
     Args:
-        ti: Time step (converted to seconds by dividing by 1000)
-        pId: Particle ID
-        coord: 3D coordinate array [x, y, z]
-        file_handle: File handle to write data to
+        ti: Time step per particle (converted to seconds by dividing by 1000)
+        pId: Particle ID of the first particle
+        coord: N x 3 coordinate array [[x, y, z], ...] (or a single [x, y, z])
+        file_handle: Binary file handle to write data to
         
     Returns:
-        Incremented particle ID
+        Particle ID following the last particle written
         
     Output format: x y z u v w start_time diameter density particle_id
     - Position: coord[0], coord[1], coord[2] 
@@ -36,49 +41,79 @@ def Output(ti, pId, coord, file_handle):
     - Start time: ti/1000.0 (convert ms to seconds)
     - Diameter: 10.0e-6 (10 micrometers)
     - Density: 977.0 kg/m³ (water droplet density)
+    
+    All particles are formatted by a single % operation on the line template
+    repeated n times, directly as ASCII bytes, then written with a single call.
     """
-    file_handle.write('{:.15f}\t{:.15f}\t{:.15f}\t0.0\t0.0\t0.0\t{:7.3f}\t10.0e-6\t977.0\t{}\n'.format(
-        coord[0], coord[1], coord[2], ti / 1000.0, pId))
-    #file_handle.write('{:.15f}\t{:.15f}\t{:.15f}\t0.0\t0.0\t0.0\t{:7.3f}\t10.0e-6\t977.0\n'.format(
-    #    coord[0], coord[1], coord[2], ti / 1000.0))
-    return pId + 1
+    coord = np.atleast_2d(coord)
+    n = len(coord)
+    times = np.broadcast_to(np.asarray(ti) / 1000.0, n)
+    values = np.column_stack([coord, times, np.arange(pId, pId + n)]).ravel().tolist()
+    line = b'%.15f\t%.15f\t%.15f\t0.0\t0.0\t0.0\t%7.3f\t10.0e-6\t977.0\t%d\n'
+    #values = np.column_stack([coord, times]).ravel().tolist()
+    #line = b'%.15f\t%.15f\t%.15f\t0.0\t0.0\t0.0\t%7.3f\t10.0e-6\t977.0\n'
+    file_handle.write((line * n) % tuple(values))
+    return pId + n
 
 def OutputStar(ti, pId, coord, file_handle):
     """
     Output particle data in simplified star format to file.
     
     Args:
-        ti: Time step (unused in this format)
-        pId: Particle ID  
-        coord: 3D coordinate array [x, y, z]
-        file_handle: File handle to write data to
+        ti: Time step per particle (unused in this format)
+        pId: Particle ID of the first particle
+        coord: N x 3 coordinate array [[x, y, z], ...] (or a single [x, y, z])
+        file_handle: Binary file handle to write data to
         
     Returns:
-        Incremented particle ID
+        Particle ID following the last particle written
         
     Output format: v, particle_id, x, y, z
     """
-    file_handle.write(f'v, {pId+1}, {coord[0]:.15f}, {coord[1]:.15f}, {coord[2]:.15f}\n')
-    return pId + 1
+    coord = np.atleast_2d(coord)
+    n = len(coord)
+    values = np.column_stack([np.arange(pId + 1, pId + n + 1), coord]).ravel().tolist()
+    line = b'v, %d, %.15f, %.15f, %.15f\n'
+    file_handle.write((line * n) % tuple(values))
+    return pId + n
 
 # Choose which output function to use
 whichOutput = Output
 # whichOutput = OutputStar
 
+# --- Parallel Output ---
+# Particle rows are formatted in chunks and written to the file in order.
+# Formatting all particles in one process takes ~0.3 s, while starting
+# worker processes costs more than that with the spawn/forkserver start
+# methods (each worker re-imports NumPy), so parallel formatting is opt-in.
+# With a single worker, usable CPU or chunk, chunks are formatted in the
+# main process.
+numWorkers = 1                  # Worker processes (None = one per usable CPU)
+chunkSize = 20000               # Particles formatted per worker task
+
 # === SIMULATION PARAMETERS ===
 
+# --- Random Number Generation ---
+# All particle positions are drawn from one NumPy generator backed by the
+# SFC64 bit generator (faster than the default PCG64 for bulk fills)
+seed = None                     # Set to an integer for reproducible output
+
 # --- Timing Configuration ---
 # Version 2: Output 5 particles every 5 ms
 # Each time step is 5 ms
 # Total current time steps = 20,000 (currently running 100,005 for ~100s)
 # Planning to extend to 30,000 time steps = 150 s
+timeStep = 5                    # Time between particle releases (ms)
+endTime = 200005                # End of simulated time range, exclusive (ms)
 
 # --- Breathing Cycle Parameters ---
 # Breath cycle = 5 s = 5000 ms
 # Exhale phase: 2.5 s (first half of cycle)
 # For exhale: 2.5 s / 0.005 s = 500 particles per exhale cycle
 # Released from time steps 0 to 360 (1.8 s)
-# Use modulo operation (ti % 5000) to determine particle release timing
+# Release times are computed once for the whole run (see ExhaleTimes)
+breathCycle = 5000              # Breath cycle length (ms)
+exhaleTime = 2500               # Exhale phase length at start of each cycle (ms)
 
 # Loop: range(0, 150005, 5)  # 5 ms resolution in integer arithmetic
 # (0.005 s * 1000 = 5, 2.5 s * 1000 = 2500)
@@ -162,85 +197,179 @@ def NoseParticleGeneration():
     # return
     # '''
     
-    # Open output file for writing
-    with open('ParticleInitial.dat', 'w') as file_handle:
+    # === PARTICLE GENERATION ===
+    # All particles are generated up front as arrays, one row per particle.
+    # The simulated time range is [0, endTime) ms (see Timing Configuration);
+    # particles are released only during the exhale phase (first exhaleTime
+    # ms of each breathCycle ms cycle)
+    exhaleTimes = ExhaleTimes()
+
+    rng = Generator(SFC64(seed))
+    times, coords = GenerateParticles(rng, exhaleTimes)
+
+    # Resolve the output function once; workers are handed it directly
+    writer = whichOutput
+
+    # Open output file for writing with a 1 MiB buffer
+    # Binary mode: rows are formatted as bytes, so no text encoding pass is needed
+    with open('ParticleInitial.dat', 'wb', buffering=1048576) as file_handle:
         # Initialize particle counter
         pId = 0
         
         # Write header for output file
-        if whichOutput == Output:
+        if writer == Output:
             # Header lines are commented out for now
-            file_handle.write('# location velocity "start time" diameter  density\n')
-            file_handle.write('# x y z       u v w\n')
+            file_handle.write(b'# location velocity "start time" diameter  density\n')
+            file_handle.write(b'# x y z       u v w\n')
             pass
 
-        # === MAIN SIMULATION LOOP ===
-        # Note: Currently iterating up to 100,005 timesteps (reduced from planned 200,005)
-        # Original plan was 40,000 timesteps, comments mention 20,000 timesteps
-        # I'm only iterating up to 20000 timesteps instead of 40000.
-        # for ti in range(0, 200005, 5):
-        for ti in range(0, 200005, 5):
-            # Calculate position within breathing cycle (5000ms = 5s cycle)
-            tm = ti % 5000
-            
-            # Generate particles only during exhale phase (first 2500ms of cycle)
-            if tm >= 0 and tm < 2500:
-                
-                # --- Generate Mouth Particles ---
-                # Generate 5 randomly distributed particles in mouth area
-                for i in range(0,5):
-                    rydel = random.uniform(0.0, ydel)
-                    y = ymin + rydel
-                    rzdel = random.uniform(0.0, zdel)
-                    z = zmin + rzdel
-                    pId = whichOutput(ti, pId, [ xPln, y, z ], file_handle)
-
-                # --- Generate Nostril Particles ---
-                # Generate 2 particles per nostril (4 total)
-                pId = GenNostril(ti, radius, pId, leftRotTrans, file_handle)
-                pId = GenNostril(ti, radius, pId, rightRotTrans, file_handle)
+        chunks = [(writer, times[i:i + chunkSize], pId + i, coords[i:i + chunkSize])
+                  for i in range(0, len(coords), chunkSize)]
+        write = file_handle.write
+        workers = min(numWorkers or UsableCpuCount(), len(chunks))
+        if workers > 1:
+            with Pool(workers) as pool:
+                for data in pool.imap(FormatChunk, chunks):
+                    write(data)
+        else:
+            # Nothing to run in parallel: skip worker start-up and pickling
+            for data in map(FormatChunk, chunks):
+                write(data)
+        pId += len(coords)
     
     print(f"Particle data written to ParticleInitial.dat with {pId} particles.")
 
-def GenNostril(ti, radius, pId, rotTrans, file_handle):
+def UsableCpuCount():
+    """
+    Number of CPUs this process may run on.
+    
+    Uses the CPU affinity mask where available, so container and taskset
+    limits are respected; falls back to os.cpu_count() elsewhere.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def FormatChunk(chunk):
     """
-    Generate particles for a single nostril.
+    Format one chunk of particles (in a worker process or in-process).
     
     Args:
-        ti: Current time step
+        chunk: (writer, ti, pId, coord) - output function (Output or
+               OutputStar) and its ti, pId, coord arguments
+        
+    Returns:
+        Formatted output bytes for the chunk
+    """
+    writer, ti, pId, coord = chunk
+    buffer = io.BytesIO()
+    writer(ti, pId, coord, buffer)
+    return buffer.getvalue()
+
+def ExhaleTimes():
+    """
+    Compute the particle release schedule once.
+    
+    Returns:
+        Array of time steps (ms) in [0, endTime) that fall in the exhale
+        phase of a breathing cycle, in increasing order
+        
+    Keeps every ti in range(0, endTime, timeStep) with
+    ti % breathCycle < exhaleTime, in a single vectorized pass.
+    """
+    times = np.arange(0, endTime, timeStep)
+    return times[times % breathCycle < exhaleTime]
+
+def GenerateParticles(rng, exhaleTimes):
+    """
+    Generate all mouth and nostril particles for the given exhale time steps.
+    
+    Args:
+        rng: NumPy random generator
+        exhaleTimes: Array of exhale time steps (ms)
+        
+    Returns:
+        (times, coords): release time step of each particle and
+        N x 3 array of particle coordinates [x, y, z]
+        
+    Particles are ordered by time step; within each time step the order is
+    5 mouth, 2 left nostril, 2 right nostril. All particles live in one
+    preallocated contiguous coordinate array whose slices are filled in
+    place, so no per-particle Python objects are created.
+    """
+    numSteps = exhaleTimes.size
+    coords = np.empty((numSteps, 9, 3))
+
+    # --- Generate Mouth Particles ---
+    # Draw all 5 randomly distributed mouth particles for every exhale
+    # time step in one batch: shape (exhale steps, 5 particles, [y, z])
+    yz = rng.uniform(0.0, 1.0, size=(numSteps, 5, 2))
+    coords[:, 0:5, 0] = xPln
+    coords[:, 0:5, 1] = ymin + yz[..., 0] * ydel
+    coords[:, 0:5, 2] = zmin + yz[..., 1] * zdel
+
+    # --- Generate Nostril Particles ---
+    # Draw 2 particles per nostril (4 total) for every exhale time step in
+    # one batch, then transform local nostril coordinates to global 3D space
+    if rightRotTrans == leftRotTrans:
+        # Both nostrils share one transformation: fill all 4 per time step at
+        # once, shape (exhale steps, 4 particles, [x, y, z])
+        GenNostril(rng, radius, leftRotTrans, coords[:, 5:9])
+    else:
+        # One call per nostril, each shape (exhale steps, 2 particles, [x, y, z])
+        GenNostril(rng, radius, leftRotTrans, coords[:, 5:7])
+        GenNostril(rng, radius, rightRotTrans, coords[:, 7:9])
+
+    times = np.repeat(exhaleTimes, 9)
+    return times, coords.reshape(-1, 3)
+
+def GenNostril(rng, radius, rotTrans, out):
+    """
+    Generate nostril particles sharing one transformation matrix.
+    
+    Called once per nostril, or once for both nostrils when their
+    transformation matrices are identical.
+    
+    Args:
+        rng: NumPy random generator
         radius: Nostril radius for particle generation
-        pId: Current particle ID counter
         rotTrans: 4x3 transformation matrix for nostril positioning
-        file_handle: File handle to write data to
+        out: Array of shape (..., 3) to fill with global 3D coordinates [x, y, z];
+             one particle is generated per row
+        
+    Returns:
+        out
+    """
+    n = out.size // 3
+    points = GenNostrilPoints(rng, radius, n).reshape(out.shape[:-1] + (2,))
+
+    # Transform local nostril coordinates to global 3D space, writing straight
+    # into out. The local z is always 0, so only the x and y columns of the
+    # rotation contribute.
+    rotTrans = np.asarray(rotTrans)
+    np.matmul(points, rotTrans[:, 0:2].T, out=out)
+    out += rotTrans[:, 3]
+    return out
+
+def GenNostrilPoints(rng, radius, n):
+    """
+    Generate particles randomly distributed within a circular nostril area.
+    
+    Args:
+        rng: NumPy random generator
+        radius: Nostril radius for particle generation
+        n: Number of particles to generate
         
     Returns:
-        Updated particle ID counter
+        n x 2 array of local nostril coordinates [x, y]
         
-    Generates 2 particles randomly distributed within circular nostril area.
-    Uses rejection sampling to ensure particles fall within circular boundary.
+    Samples the disk directly in polar coordinates: taking r = radius*sqrt(u)
+    makes the points uniform over the area, so exactly two random numbers are
+    needed per particle and no candidates are rejected.
     """
-    x = 0.0
-    y = 0.0
-
-    # Generate 2 particles per nostril per time step
-    for i in range(0,2):
-        # Use rejection sampling to generate particles within circular nostril
-        while True:
-            # Generate random coordinates within square [-radius, radius]
-            # These calculations provide the best particle distribution throughout
-            # the model volume according to testing
-            x = radius * random.uniform(-1.0, 1.0)
-            y = radius * random.uniform(-1.0, 1.0)
-            
-            # Accept only if point falls within circle
-            if x*x + y*y < radius*radius:
-                break
-
-        # Transform local nostril coordinates to global 3D space
-        coord = RotTrans(rotTrans, [ x, y, 0.0 ])
-        pId = whichOutput(ti, pId, coord, file_handle)
-
-    return pId
+    r = radius * np.sqrt(rng.random(n))
+    theta = 2.0 * np.pi * rng.random(n)
+    return np.column_stack([r * np.cos(theta), r * np.sin(theta)])
 
 def RotTrans(rotTrans, coord):
     """
@@ -248,10 +377,10 @@ def RotTrans(rotTrans, coord):
     
     Args:
         rotTrans: 4x3 transformation matrix [rotation + translation]
-        coord: 3D coordinate vector [x, y, z]
+        coord: 3D coordinate vector [x, y, z], or N x 3 array of them
         
     Returns:
-        Transformed 3D coordinate vector
+        Transformed 3D coordinates, same shape as coord
         
     Transformation matrix format:
     [[r11, r12, r13, tx],
@@ -259,13 +388,10 @@ def RotTrans(rotTrans, coord):
      [r31, r32, r33, tz]]
     
     Where r_ij are rotation matrix elements and tx,ty,tz are translation offsets.
+    All coordinates are transformed with a single matrix product.
     """
-    return [ rotTrans[0][0] * coord[0] + rotTrans[0][1] * coord[1]
-             + rotTrans[0][2] * coord[2] + rotTrans[0][3],
-             rotTrans[1][0] * coord[0] + rotTrans[1][1] * coord[1]
-             + rotTrans[1][2] * coord[2] + rotTrans[1][3],
-             rotTrans[2][0] * coord[0] + rotTrans[2][1] * coord[1]
-             + rotTrans[2][2] * coord[2] + rotTrans[2][3] ]
+    rotTrans = np.asarray(rotTrans)
+    return np.asarray(coord) @ rotTrans[:, :3].T + rotTrans[:, 3]
 
 # === PROGRAM ENTRY POINT ===
 if __name__ == '__main__':